@@ -4,15 +4,20 @@ Global Secondary Indexes on a DynamoDB Table
 
 import logging
 import boto3
+from botocore.exceptions import ClientError
+from botocore.config import Config
 import os
 import time
-import math
+import random
 import json
-import urllib
+import re
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 
-# parse logging level from environment variable 'logging_level' if set
+# parse logging level from environment variable 'logging_level', defaulting to INFO
 LOGGING_LEVEL = os.environ.get("logging_level", "")
-log_level = getattr(logging, LOGGING_LEVEL, logging.NOTSET)
+LEVELS = logging.getLevelNamesMapping()
+log_level = LEVELS.get(LOGGING_LEVEL.upper(), logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 # quite down the botocore debug output because it can be quite noisy and distracting
@@ -22,257 +27,294 @@ logging.getLogger("botocore.vendored.requests.packages.urllib3.connectionpool").
 TABLE_NAME = os.environ.get("TABLE_NAME")
 GSI_1 = os.environ.get("GSI_1")
 GSI_2 = os.environ.get("GSI_2")
+# whether to wait for the GSIs to be ACTIVE before reporting success to Cloud Formation
+WAIT_FOR_GSIS = os.environ.get("WAIT_FOR_GSIS", "true").lower() != "false"
+
+# instantiate a dynamodb client, keeping the connection alive between polls
+# and letting botocore back off adaptively when requests are throttled
+client_config = Config(
+    retries={
+        'max_attempts': 10,
+        'mode': 'adaptive'
+    },
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=5,
+    max_pool_connections=4
+)
+client = boto3.client('dynamodb', config=client_config)
+# update_table is only tried once, LimitExceeded (another GSI still building) is treated
+# as throttling by botocore and would otherwise be retried with long, unbounded sleeps
+_update_client = boto3.client('dynamodb', config=client_config.merge(Config(
+    retries={
+        'mode': 'standard',
+        'total_max_attempts': 1
+    }
+)))
+
+# reuse the https connection for Cloud Formation status responses
+_http = urllib3.PoolManager(num_pools=2, maxsize=2, retries=urllib3.Retry(3, backoff_factor=0.5))
+
+# update_table payloads used to create each of the GSIs
+_GSI1_KWARGS = {
+    'AttributeDefinitions': [
+        {
+            'AttributeName': 'primary',
+            'AttributeType': 'N'
+        },
+        {
+            'AttributeName': 'gsikey',
+            'AttributeType': 'N'
+        },
+    ],
+    'TableName': TABLE_NAME,
+    'GlobalSecondaryIndexUpdates': [{
+        'Create': {
+            'IndexName': GSI_1,
+            'KeySchema': [
+                {
+                    'AttributeName': 'gsikey',
+                    'KeyType': 'HASH'
+                },
+            ],
+            'Projection': {
+                'ProjectionType': 'INCLUDE',
+                'NonKeyAttributes': [
+                    'primary'
+                ]
+            },
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        }
+    }
+    ]
+}
+
+_GSI2_KWARGS = {
+    'AttributeDefinitions': [
+        {
+            'AttributeName': 'primary',
+            'AttributeType': 'N'
+        },
+        {
+            'AttributeName': 'gsikey',
+            'AttributeType': 'N'
+        },
+        {
+            'AttributeName': 'gsisortkey',
+            'AttributeType': 'N'
+        },
+    ],
+    'TableName': TABLE_NAME,
+    'GlobalSecondaryIndexUpdates': [{
+        'Create': {
+            'IndexName': GSI_2,
+            'KeySchema': [
+                {
+                    'AttributeName': 'gsikey',
+                    'KeyType': 'HASH'
+                },
+                {
+                    'AttributeName': 'gsisortkey',
+                    'KeyType': 'RANGE'
+                }
+            ],
+            'Projection': {
+                'ProjectionType': 'INCLUDE',
+                'NonKeyAttributes': [
+                    'primary'
+                ]
+            },
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        }
+    }
+    ]
+}
+
+# DynamoDB reports an index that already exists as a ValidationException
+_ALREADY_EXISTS_CODE = 'ValidationException'
+_ALREADY_EXISTS = re.compile(r'already exists', re.IGNORECASE)
 
-# instantiate a dynamodb client
-client = boto3.client('dynamodb')
+# capped exponential backoff (in seconds) used when polling the GSI status
+MAX_WAIT_SECONDS = 15
+BACKOFF = tuple(min(MAX_WAIT_SECONDS, 2 ** i) for i in range(MAX_WAIT_SECONDS + 1))
 
+# stop polling while there is still time left to report back to Cloud Formation
+TIMEOUT_BUFFER_MILLIS = 10000
 
-def check_table_status(tablename: str):
-    """ Check to see if a dynamo table is in an ACTIVE state'
 
-    Dynamo tables are updated async, and an update needs to be completed
-    before another update can be started otherwise an exception is raised.
+def describe_once(tablename: str):
+    """ Check the status of a dynamo table and its GSIs
+
+    A single describe_table call is used to check both the table status
+    and the status of all of its GSIs.
 
     Args:
         tablename: name of the table to check status
 
     Returns:
-        table_active: [bool] if the table is in an active state
+        (table_active, gsi_active): [bool, bool] if the table and all of its GSIs are in an active state
     """
-    response = client.describe_table(
-        TableName=tablename
-    )
     try:
-        table_status = response['Table']['TableStatus']
-        if table_status == 'ACTIVE':
-            table_active = True
-        else:
-            table_active = False
-    except:
-        logger.debug('Table Status not returned')
-        table_active = True
-    logger.debug(table_status)
-    return table_active
-
-
-def check_gsi_status(tablename: str):
-    """ Check to see that all GSIs on a dynamo table are in the ACTIVE state
+        response = client.describe_table(
+            TableName=tablename
+        )
+    except ClientError as e:
+        request_id = e.response.get('ResponseMetadata', {}).get('RequestId')
+        logger.warning("Failed to describe table [%s] (RequestId: %s): %s", tablename, request_id, e)
+        return False, False
+    if response is None or 'Table' not in response:
+        logger.debug('Table description not returned')
+        return False, False
+    table = response['Table']
+    table_active = table.get('TableStatus') == 'ACTIVE'
+    # stops at the first GSI that is not ACTIVE, and is True when there are no GSIs
+    gsi_active = all(g['IndexStatus'] == 'ACTIVE' for g in table.get('GlobalSecondaryIndexes', ()))
+    return table_active, gsi_active
+
+
+def table_status_wait(table_name: str, context=None, wait_seconds: int=5, max_attempts: int=40):
+    """Wait for table to be active
+
+    Use the boto3 `table_exists` waiter to wait for the table to have a state
+    of ACTIVE. The GSIs on the table may still be backfilling.
+    If a Lambda context is given, the number of polls is bounded by the time
+    left before the function times out instead of by max_attempts.
 
     Args:
-        tablename: name of the table to check status
+        table_name: name of the dynamo table for which we want a status check
+        context: Lambda context object
+        wait_seconds: number of seconds to wait in between pollings
+        max_attempts: maximum number of times to poll the table
 
-    Returns:
-        gsis_active: [bool] if the table is in an active state
+    Returns: N/A
     """
-    response = client.describe_table(
-        TableName=tablename
+    if context:
+        max_attempts = (context.get_remaining_time_in_millis() - TIMEOUT_BUFFER_MILLIS) // (wait_seconds * 1000)
+        if max_attempts < 1:
+            raise TimeoutError(f'Function was about to timeout waiting for table [{table_name}]')
+    waiter = client.get_waiter('table_exists')
+    waiter.wait(
+        TableName=table_name,
+        WaiterConfig={
+            'Delay': wait_seconds,
+            'MaxAttempts': max_attempts
+        }
     )
-    try:
-        if "GlobalSecondaryIndexes" in response['Table']:
-            GSIs = [n['IndexStatus'] for n in response['Table']['GlobalSecondaryIndexes']]
-            if all([n == 'ACTIVE' for n in GSIs]):
-                gsi_active = True
-            else:
-                gsi_active = False
-        else:
-            logger.info('No GSIs present, continuing...')
-            gsi_active = True
-    except:
-        gsi_active = True
-        logger.debug('Failed to get GSIs')
-    return gsi_active
-
-	
-def table_active_wait(table_name: str, wait_seconds: int=15):
+    logger.debug("Table [%s] is active", table_name)
+
+
+def table_active_wait(table_name: str, context=None, wait_seconds: int=5, max_attempts: int=40):
     """Wait for table and its GSIs to be active
 
-    Poll dynamo table status and wait for it to have a state of ACTIVE.
-    The wait time between iterations is an increasing backoff.
+    If the table is not ACTIVE, use the boto3 `table_exists` waiter to wait for
+    it to be, then poll the table description until all of its GSIs are ACTIVE.
+    The wait time between GSI polls is a capped exponential backoff with jitter.
+    If a Lambda context is given, give up before the function times out so
+    that a failure can still be reported to Cloud Formation.
 
     Args:
         table_name: name of the dynamo table for which we want a status check
-        wait_seconds: number of seconds to wait in between pollings
+        context: Lambda context object
+        wait_seconds: number of seconds the waiter waits in between pollings
+        max_attempts: maximum number of times the waiter polls the table when no context is given
 
     Returns: N/A
     """
-    table_active = False
-    retry = 0
-
-    while not table_active:
-        if retry > wait_seconds:
-            retry = wait_seconds
-        exp_wait = math.floor(wait_seconds ** (retry / wait_seconds))
-        logger.debug(f"Table [{table_name}] not active, waiting [{exp_wait}] seconds to poll again")
-        time.sleep(exp_wait)
-        table_active = check_table_status(table_name)
-        logger.debug(table_active)
-        retry += 1
-    logger.debug(f"Table [{table_name}] is active")
-
-    # check that the GSIs are all active
-    gsi_active = False
+    # only use the waiter while the table itself is not active, e.g. the GSIs
+    # may already have been created by a previous invocation
+    table_active, gsi_active = describe_once(table_name)
+    if not table_active:
+        table_status_wait(table_name, context, wait_seconds, max_attempts)
+        table_active, gsi_active = describe_once(table_name)
+
+    # check that the table and its GSIs are all active
     retry = 0
-    while not gsi_active:
-        if retry > wait_seconds:
-            retry = wait_seconds
-        exp_wait = math.floor(wait_seconds ** (retry / wait_seconds))
-        logger.debug(f"Table [{table_name}] GSIs not active, waiting [{exp_wait}] seconds to poll again")
+    while not (table_active and gsi_active):
+        # add jitter so concurrent stacks don't poll in lockstep
+        exp_wait = BACKOFF[min(retry, len(BACKOFF) - 1)] + random.random()
+        if context and context.get_remaining_time_in_millis() - exp_wait * 1000 <= TIMEOUT_BUFFER_MILLIS:
+            raise TimeoutError(f'Function was about to timeout waiting for table [{table_name}]')
+        logger.debug("Table [%s] or its GSIs not active, waiting [%.2f] seconds to poll again", table_name, exp_wait)
         time.sleep(exp_wait)
-        gsi_active = check_gsi_status(table_name)
-        logger.debug(gsi_active)
         retry += 1
-    logger.debug(f"Table [{table_name}] GSIs are active")
+        table_active, gsi_active = describe_once(table_name)
+    logger.debug("Table [%s] GSIs are active", table_name)
     return
 
 
-def function_retry(fn,):
-    """Function retry wrapper
-		
-		This is used as a decorator to retry a function a set number of times with a set wait period between
-		executions.
+def create_gsi(update_kwargs: dict, context=None, retry: bool=True):
+    """Create a GSI
+
+    Request the creation of a Global Secondary Index with update_table.
+    The call is not retried by botocore, if the table or another GSI is still
+    being updated then wait for the table and its GSIs to be active and try once more.
 
     Args:
-        fn: wrapped function
-        num_retries: number of times to retry function
-        wait_seconds: number of seconds to wait in between function calls
+        update_kwargs: update_table payload creating the GSI
+        context: Lambda context object
+        retry: whether to wait and retry if the table is busy
 
     Returns:
-        wrapper: The wrapped function
+        created: [bool] False if the GSI already exists
     """
-
-    def wrapper(context, *args, num_retries=5, wait_seconds=30, **kwargs):
-        retry = 0
-        while retry <= num_retries:
-            if context.get_remaining_time_in_millis() <= 10000:
-                raise Exception('Function was about to timeout')
-            try:
-                return fn(*args, **kwargs)
-            except Exception as e:
-                logger.debug(f"Retrying function [{fn.__name__}] after waiting [{wait_seconds}] seconds.")
-                logger.debug(f"Retries remaining: [{num_retries - retry}]")
-                logger.debug(f"Retry caused by: {e}")
-                if 'already exists' in str(e):
-                    logger.info(f'GSI Already created for {fn.__name__}')
-                    return
-                time.sleep(wait_seconds)
-                retry += 1
-                if retry > num_retries:
-                    logger.info(f"{fn.__name__} failed after {num_retries} retries")
-    return wrapper
-
-
-@function_retry
-def create_gsi_1():
+    try:
+        _update_client.update_table(**update_kwargs)
+    except (_update_client.exceptions.LimitExceededException, _update_client.exceptions.ResourceInUseException) as e:
+        if not retry:
+            raise
+        logger.info("Table busy, waiting to retry: %s", e)
+        table_active_wait(update_kwargs['TableName'], context)
+        return create_gsi(update_kwargs, context, retry=False)
+    except ClientError as e:
+        error = e.response.get('Error', {})
+        if error.get('Code') == _ALREADY_EXISTS_CODE and _ALREADY_EXISTS.search(error.get('Message', '')):
+            return False
+        raise
+    return True
+
+
+def create_gsi_1(context=None):
     """Create GSI 1
 
     Creates the Global Secondary Indexes for GSI 1
     in DynamoDB.
 
+    Args:
+        context: Lambda context object
+
     Returns:
         N/A
     """
-    try:
-        logger.info("ADDING GSI 1")
-        response = client.update_table(
-            AttributeDefinitions=[
-                {
-                    'AttributeName': 'primary',
-                    'AttributeType': 'N'
-                },
-                {
-                    'AttributeName': 'gsikey',
-                    'AttributeType': 'N'
-                },
-            ],
-            TableName=TABLE_NAME,
-            GlobalSecondaryIndexUpdates=[{
-                'Create': {
-                              'IndexName': GSI_1,
-                              'KeySchema': [
-                                  {
-                                      'AttributeName': 'gsikey',
-                                      'KeyType': 'HASH'
-                                  },
-                              ],
-                              'Projection': {
-                                  'ProjectionType': 'INCLUDE',
-                                  'NonKeyAttributes': [
-                                      'primary'
-                                  ]
-                              },
-                              'ProvisionedThroughput': {
-                                  'ReadCapacityUnits': 5,
-                                  'WriteCapacityUnits': 5
-                              }
-                          }
-            }
-            ]
-        )
-        logger.info(f"GSI 1 added!")
-    except Exception as e:
-        raise e
-        logger.debug(f"Failed to add GSI 1\n{e}")
+    logger.info("ADDING GSI 1")
+    if create_gsi(_GSI1_KWARGS, context):
+        logger.info("GSI 1 added!")
+    else:
+        logger.info("GSI 1 already exists")
 
 
-@function_retry
-def create_gsi_2():
+def create_gsi_2(context=None):
     """Create GSI 2
 
     Creates the Global Secondary Indexes for GSI 2
     in DynamoDB with sort key.
 
+    Args:
+        context: Lambda context object
+
     Returns:
         N/A
     """
-    try:
-        logger.info("ADDING GSI 2")
-        response = client.update_table(
-            AttributeDefinitions=[
-                {
-                    'AttributeName': 'primary',
-                    'AttributeType': 'N'
-                },
-                {
-                    'AttributeName': 'gsikey',
-                    'AttributeType': 'N'
-                },
-                {
-                    'AttributeName': 'gsisortkey',
-                    'AttributeType': 'N'
-                },
-            ],
-            TableName=TABLE_NAME,
-            GlobalSecondaryIndexUpdates=[{
-                'Create': {
-                    'IndexName': GSI_2,
-                    'KeySchema': [
-                        {
-                            'AttributeName': 'gsikey',
-                            'KeyType': 'HASH'
-                        },
-                        {
-                            'AttributeName': 'gsisortkey',
-                            'KeyType': 'RANGE'
-                        }
-                    ],
-                    'Projection': {
-                        'ProjectionType': 'INCLUDE',
-                        'NonKeyAttributes': [
-                            'primary'
-                        ]
-                    },
-                    'ProvisionedThroughput': {
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    }
-                }
-            }
-            ]
-        )
-        logger.info(f"GSI 2 added!")
-    except Exception as e:
-        raise e
-        logger.debug(f"Failed to add GSI 2\n{e}")
+    logger.info("ADDING GSI 2")
+    if create_gsi(_GSI2_KWARGS, context):
+        logger.info("GSI 2 added!")
+    else:
+        logger.info("GSI 2 already exists")
 
 
 def send_response(context, event, status: str='SUCCESS', reason: str=None):
@@ -300,25 +342,28 @@ def send_response(context, event, status: str='SUCCESS', reason: str=None):
             'StackId': event['StackId'],
             'RequestId': event['RequestId'],
             'LogicalResourceId': event['LogicalResourceId']
-        }
+        },
+        separators=(',', ':')
     )
     encoded_body = response_body.encode()
-    logger.info(f"Response: {response_body}")
-    request = urllib.request.Request(url=event['ResponseURL'],
-                                     method='PUT',
-                                     data=encoded_body,
-                                     headers={
-                                         "content-type": "",
-                                         "content-length": len(encoded_body)
-                                     }
-                                     )
-    logger.info(f'Response Request: {request.__dict__}')
+    logger.info('Response: %s', response_body)
+    headers = {
+        "content-type": "",
+        "content-length": str(len(encoded_body))
+    }
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Response Request: PUT %s %s', event['ResponseURL'], headers)
     logger.info('Sending status response...')
     try:
-        urllib.request.urlopen(request)
-        logger.info('Status response sent!')
+        response = _http.request('PUT', event['ResponseURL'], body=encoded_body, headers=headers)
     except Exception as e:
-        logger.exception(f'Failed to send status response:\n{e}')
+        logger.exception('Failed to send status response:\n%s', e)
+        return
+    # urllib3 doesn't raise on HTTP error statuses
+    if 200 <= response.status < 300:
+        logger.info('Status response sent! [%s]', response.status)
+    else:
+        logger.error('Failed to send status response: [%s] %s', response.status, response.data)
 
 
 def lambda_handler(event, context):
@@ -333,24 +378,42 @@ def lambda_handler(event, context):
     Returns:
         N/A
     """
-    logger.debug(f'EVENT: {event}')
-    logger.debug(f'CONTEXT: {context.__dict__}')
-
-    # GSI 1
-    table_active_wait(TABLE_NAME)
-    logger.info(f'Creating GSI 1 on {TABLE_NAME}')
-    create_gsi_1(context)
-
-    # GSI 2
-    table_active_wait(TABLE_NAME)
-    logger.info(f'Creating GSI 2 on {TABLE_NAME}')
-    create_gsi_2(context)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('EVENT: %s', event)
+        logger.debug('CONTEXT: %s', context.__dict__)
 
-
-    # send success message
-    table_active_wait(TABLE_NAME)
     try:
-        send_response(context, event, status='SUCCESS')
-    except:
-        logging.error('Failed to send the success message')
+        # GSI 1
+        table_active_wait(TABLE_NAME, context)
+        logger.info('Creating GSI 1 on %s', TABLE_NAME)
+        create_gsi_1(context)
+
+        # GSI 2, DynamoDB only builds one GSI at a time so wait for GSI 1 to be active
+        table_active_wait(TABLE_NAME, context)
+        logger.info('Creating GSI 2 on %s', TABLE_NAME)
+        create_gsi_2(context)
+
+        if WAIT_FOR_GSIS:
+            table_active_wait(TABLE_NAME, context)
+    except Exception as e:
+        logger.exception('Failed to add the GSIs:\n%s', e)
         send_response(context, event, status='FAILURE')
+        return
+
+    if WAIT_FOR_GSIS:
+        # send success message
+        send_response(context, event, status='SUCCESS')
+        return
+
+    # send success message while the GSIs finish backfilling
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(send_response, context, event, 'SUCCESS')
+        try:
+            table_active_wait(TABLE_NAME, context)
+            logger.info('GSIs on %s are active', TABLE_NAME)
+        except Exception as e:
+            logger.exception('GSIs did not become active:\n%s', e)
+        try:
+            future.result()
+        except Exception as e:
+            logger.exception('Failed to send the success message:\n%s', e)